@@ -5,7 +5,7 @@ a = Analysis(
     ['desktop_app.py'],
     pathex=[],
     binaries=[],
-    datas=[('app.py', '.'), ('db.py', '.'), ('utils.py', '.')],
+    datas=[('app.py', '.'), ('db.py', '.'), ('utils.py', '.'), ('local_replica.py', '.')],
     hiddenimports=['streamlit', 'webview', 'pandas', 'sqlite3'],
     hookspath=[],
     hooksconfig={},
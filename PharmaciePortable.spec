@@ -5,7 +5,7 @@ a = Analysis(
     ['desktop_portable.py'],
     pathex=[],
     binaries=[],
-    datas=[('app.py', '.'), ('db.py', '.'), ('utils.py', '.')],
+    datas=[('app.py', '.'), ('db.py', '.'), ('utils.py', '.'), ('local_replica.py', '.')],
     hiddenimports=['streamlit', 'pandas', 'sqlite3', 'requests', 'pathlib', 'threading', 'subprocess', 'webbrowser', 'datetime', 'contextlib', 'typing'],
     hookspath=[],
     hooksconfig={},
@@ -8,20 +8,185 @@ import streamlit as st
 import pandas as pd
 
 import db
+import local_replica
 from utils import validate_expiry_date, validate_quantity, normalize_date
 
-# Initialize database on app start
-_db_initialized = False
-if not _db_initialized:
+# Initialize database on app start (une seule fois par processus : init_db
+# et start_local_replica ne font rien lors des exécutions suivantes)
+if db.LOCAL_REPLICA:
+    # Réplique locale (LOCAL_REPLICA=1) : la base centrale est initialisée
+    # par le thread de synchronisation, l'application démarre hors ligne
+    local_replica.start_local_replica()
+else:
     db.init_db()
-    _db_initialized = True
 
 st.set_page_config(page_title="Pharmacie - Gestion de Stock", page_icon="💊", layout="wide")
 
+# Compter les requêtes SQL de cette exécution de la page
+db.begin_request_metrics()
+
+# Écoute des modifications faites depuis les autres postes (LISTEN/NOTIFY)
+db.start_change_listener()
+# Vérification quotidienne des dates d'expiration (table alerts)
+db.start_expiry_alert_scheduler()
+# Version des données affichée par cette exécution de la page
+st.session_state.seen_data_version = db.get_data_version()
+# Vrai si cette exécution a été relancée par watch_remote_changes
+remote_refresh = st.session_state.pop("remote_refresh", False)
+
 
 def refresh():
     st.rerun()
 
+
+@st.fragment(run_every=5)
+def watch_remote_changes():
+    """Relance la page seulement si les données ont changé depuis son affichage.
+
+    Une boîte de dialogue de l'onglet Gestion ouverte à ce moment-là est
+    rouverte par la nouvelle exécution (voir manage_dialog), avec sa saisie.
+    """
+    if db.get_data_version() != st.session_state.get("seen_data_version"):
+        st.session_state.remote_refresh = True
+        st.rerun()
+    if db.LOCAL_REPLICA:
+        show_sync_status()
+
+
+def show_sync_status():
+    """État de la réplique locale : connexion, opérations en attente et conflits."""
+    status = local_replica.get_sync_status()
+    if status["online"] is False:
+        st.warning(f"🟠 Hors ligne — {status['pending']} opération(s) en attente de synchronisation")
+    elif status["pending"]:
+        st.caption(f"🔄 Synchronisation de {status['pending']} opération(s)...")
+    else:
+        st.caption("🟢 Synchronisé")
+    if status["conflicts"]:
+        with st.expander(f"⚠️ {status['conflicts']} conflit(s) de synchronisation"):
+            for conflict in local_replica.get_sync_conflicts():
+                st.write(f"{conflict['created_at'][:16].replace('T', ' ')} — {conflict['message']}")
+            if st.button("Marquer comme vus", use_container_width=True, key="ack_sync_conflicts"):
+                local_replica.acknowledge_conflicts()
+                st.rerun()
+
+
+# Couleur de fond de la colonne État selon la catégorie d'expiration calculée par la base
+EXPIRY_BUCKET_COLORS = {
+    "EXCELLENT": "background-color: #e8f5e8",  # Vert très clair, plus de 90 jours
+    "À SURVEILLER": "background-color: #fff8dc",  # Jaune très clair (cornsilk), 30 à 90 jours
+    "URGENT": "background-color: #ffe4e1",  # Rouge très clair (mistyrose), moins de 30 jours
+}
+
+# Noms de colonnes acceptés pour l'import en masse
+IMPORT_COLUMNS = {
+    "name": ["name", "nom", "désignation", "designation", "produit"],
+    "quantity": ["quantity", "quantité", "quantite", "qté", "qte"],
+    "expiry_date": ["expiry_date", "date d'expiration", "expiration", "exp"],
+}
+
+
+def parse_import_rows(df: pd.DataFrame) -> tuple[list[dict], list[str]]:
+    """Valide un fichier fournisseur et retourne (lignes valides, erreurs)."""
+    columns = {str(c).strip().lower(): c for c in df.columns}
+    mapping = {}
+    for field, aliases in IMPORT_COLUMNS.items():
+        found = next((columns[a] for a in aliases if a in columns), None)
+        if found is None:
+            return [], [f"Colonne manquante : {' / '.join(aliases[:3])}"]
+        mapping[field] = found
+
+    rows, errors = [], []
+    for i, (nm, q, ex) in enumerate(zip(df[mapping["name"]], df[mapping["quantity"]], df[mapping["expiry_date"]]), start=2):
+        nm = "" if pd.isna(nm) else str(nm).strip()
+        ex = "" if pd.isna(ex) else str(ex).strip()[:10]
+        ok_q, qty_norm, err_q = validate_quantity("" if pd.isna(q) else str(q))
+        ok_d, iso_date, err_d = validate_expiry_date(ex)
+        if not nm:
+            errors.append(f"Ligne {i} : le nom du produit est requis.")
+        elif not ok_q:
+            errors.append(f"Ligne {i} ({nm}) : {err_q}")
+        elif not ok_d:
+            errors.append(f"Ligne {i} ({nm}) : {err_d}")
+        else:
+            rows.append({"name": nm, "quantity": qty_norm, "expiry_date": iso_date})
+    return rows, errors
+
+
+HISTORY_EXPORT_COLUMNS = [
+    "id", "operation", "product_id", "product_name", "old_quantity", "new_quantity",
+    "old_expiry_date", "new_expiry_date", "timestamp", "details",
+]
+
+
+def purge_history_exports(max_age_seconds: int = 3600) -> None:
+    """Supprime les fichiers historique_* laissés dans le dossier temporaire.
+
+    build_history_export supprime son fichier dès qu'il l'a relu ; il ne
+    reste que ceux d'un processus arrêté en cours d'export. Seuls les
+    fichiers de plus de ``max_age_seconds`` sont supprimés, pour ne pas
+    toucher à un export en cours dans une autre session.
+    """
+    import glob
+    import os
+    import tempfile
+    import time
+
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), "historique_*")):
+        try:
+            if time.time() - os.path.getmtime(path) > max_age_seconds:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def build_history_export(fmt: str, operations: Optional[list] = None, chunk_size: int = 5000) -> bytes:
+    """Exporte l'historique (CSV ou Parquet) par blocs via db.iter_history.
+
+    Les lignes sont écrites au fil de l'eau dans un fichier temporaire :
+    seul un bloc de ``chunk_size`` lignes est en mémoire pendant la
+    construction. Le fichier terminé est relu une seule fois et supprimé ;
+    son contenu est retourné pour le bouton de téléchargement.
+    """
+    import csv
+    import io
+    import os
+    import tempfile
+    from itertools import islice
+
+    purge_history_exports()
+    rows = db.iter_history(operations=operations, chunk_size=chunk_size)
+    suffix = ".parquet" if fmt == "Parquet" else ".csv"
+    with tempfile.NamedTemporaryFile(prefix="historique_", suffix=suffix, delete=False) as tmp:
+        try:
+            if fmt == "Parquet":
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                schema = pa.schema([
+                    ("id", pa.int64()), ("operation", pa.string()), ("product_id", pa.int64()),
+                    ("product_name", pa.string()), ("old_quantity", pa.int64()), ("new_quantity", pa.int64()),
+                    ("old_expiry_date", pa.date32()), ("new_expiry_date", pa.date32()),
+                    ("timestamp", pa.timestamp("us", tz="UTC")), ("details", pa.string()),
+                ])
+                with pq.ParquetWriter(tmp, schema) as writer:
+                    while chunk := list(islice(rows, chunk_size)):
+                        writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            else:
+                text_out = io.TextIOWrapper(tmp, encoding="utf-8-sig", newline="")
+                writer = csv.DictWriter(text_out, fieldnames=HISTORY_EXPORT_COLUMNS, extrasaction="ignore", delimiter=";")
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow(row)
+                text_out.flush()
+                text_out.detach()
+            tmp.seek(0)
+            return tmp.read()
+        finally:
+            tmp.close()
+            os.remove(tmp.name)
+
+
 # --------------- Dialogs ---------------
 @st.dialog("Modifier le produit")
 def edit_product_dialog(prod_id: int, name: str, quantity: int, expiry: str):
@@ -136,40 +301,42 @@ def delete_product_dialog(prod_id: int, name: str):
 
 
 @st.dialog("Confirmer la sortie")
-def confirm_stockout_dialog(pending: dict):    
+def confirm_stockout_dialog(pending: list):
     # Message d'information
-    st.info("Veuillez vérifier les informations suivantes :")
-    
-    # Informations en colonnes
-    col1, col2 = st.columns(2)
-    with col1:
-        st.markdown(f"**Produit :** {pending['name']}")
-    with col2:
-        st.markdown(f"**Motif :** {pending['reason']}")
-    
-    st.markdown(f"**Quantité :** {pending['qty']}")
-    
+    st.info("Veuillez vérifier les lignes de la sortie :")
+
+    # Récapitulatif du panier
+    st.dataframe(
+        pd.DataFrame([
+            {"Produit": line["name"], "Exp": line["exp"], "Quantité": line["qty"], "Motif": line["reason"]}
+            for line in pending
+        ]),
+        use_container_width=True,
+        hide_index=True,
+    )
+    st.markdown(f"**Total :** {sum(line['qty'] for line in pending)} unité(s) sur {len(pending)} ligne(s)")
+
     st.divider()
-    
+
     # Boutons d'action
     b1, b2 = st.columns(2)
     with b1:
         if st.button("✓ Confirmer la sortie", type="primary", use_container_width=True, key="dlg_confirm_stockout"):
             try:
-                db.remove_stock(
-                    product_id=pending['id'],
-                    quantity=pending['qty'],
-                    reason=pending['reason']
+                remaining = db.remove_stock_many(
+                    [(line["id"], line["qty"], line["reason"]) for line in pending]
                 )
             except Exception as e:
                 st.error(f"Erreur lors de l'enregistrement : {e}")
             else:
-                # Message personnalisé selon si le stock atteint zéro
-                if pending['new_stock'] == 0:
-                    st.session_state.show_stockout_success = "🔴 Sortie de stock enregistrée ! Le produit a été supprimé car le stock est épuisé."
+                # Message personnalisé selon si des lots ont été épuisés
+                depleted = sum(1 for q in remaining.values() if q == 0)
+                if depleted:
+                    st.session_state.show_stockout_success = f"🔴 Sortie de stock enregistrée ! {depleted} produit(s) supprimé(s) car le stock est épuisé."
                 else:
                     st.session_state.show_stockout_success = "✅ Sortie de stock enregistrée avec succès !"
                 del st.session_state["stockout_pending"]
+                st.session_state.stockout_basket = []
                 refresh()
     with b2:
         if st.button("✕ Annuler", use_container_width=True, key="dlg_cancel_stockout"):
@@ -180,6 +347,61 @@ def confirm_stockout_dialog(pending: dict):
 # --------------- Sidebar ---------------
 st.sidebar.title("🔎 Recherche")
 search = st.sidebar.text_input("Nom du produit")
+with st.sidebar:
+    watch_remote_changes()
+
+# Lectures réservées à la base centrale (alertes, statistiques) : avec la
+# réplique locale, elles ne sont tentées que si la dernière synchronisation
+# l'a jointe, pour ne pas attendre DB_CONNECT_TIMEOUT à chaque exécution
+central_online = not db.LOCAL_REPLICA or local_replica.is_online()
+
+# Alertes d'expiration : seule la petite table alerts est lue ici
+unread_alerts = 0
+if central_online:
+    try:
+        unread_alerts = db.get_unread_alert_count()
+    except Exception:
+        pass  # Liaison coupée depuis la dernière synchronisation
+if unread_alerts:
+    with st.sidebar.expander(f"🔔 {unread_alerts} alerte(s) d'expiration non lue(s)"):
+        alerts = db.get_alerts(limit=20)
+        for alert in alerts:
+            threshold = "échéance atteinte" if alert["threshold_days"] == 0 else f"moins de {alert['threshold_days']} jours"
+            st.write(f"**{alert['product_name']}** — Qté {alert['quantity']} — Exp {alert['expiry_date']} ({threshold})")
+        if unread_alerts > len(alerts):
+            st.caption(f"... et {unread_alerts - len(alerts)} autre(s)")
+        if st.button("Marquer comme lues", use_container_width=True, key="mark_alerts_read"):
+            db.mark_alerts_read([alert["id"] for alert in alerts])
+            refresh()
+
+# Panneau d'administration optionnel (ADMIN_PANEL=1 dans .env ou database_config.txt)
+if db.get_setting("ADMIN_PANEL", "0") in ("1", "true", "yes"):
+    with st.sidebar.expander("🛠️ Performances base de données"):
+        last_run = st.session_state.get("last_run_db_metrics")
+        if last_run:
+            st.caption(
+                f"Dernière exécution : {last_run['queries']} requête(s), "
+                f"{last_run['rows']} ligne(s), {last_run['time'] * 1000:.0f} ms en base"
+            )
+        metrics = db.get_query_metrics()
+        if metrics["functions"]:
+            st.dataframe(
+                pd.DataFrame(metrics["functions"])[["name", "calls", "p50_ms", "p95_ms", "p99_ms", "queries", "rows"]]
+                .rename(columns={"name": "Fonction", "calls": "Appels", "queries": "Requêtes", "rows": "Lignes"})
+                .round(1),
+                use_container_width=True,
+                hide_index=True,
+            )
+        pool = db.get_pool_stats()
+        st.caption(
+            f"Pool : {pool['checked_out']}/{pool['pool_size']} utilisée(s), débordement {max(pool['overflow'], 0)}, "
+            f"attente moy. {pool['wait_avg_ms']:.1f} ms (max {pool['wait_max_ms']:.0f} ms), "
+            f"{pool['timeouts']} expiration(s)"
+        )
+        if st.button("Réinitialiser les mesures", use_container_width=True):
+            db.reset_query_metrics()
+            db.reset_pool_stats()
+            refresh()
 
 st.title("💊 Application de gestion de stock de pharmacie")
 st.caption("Ajouter, modifier et supprimer des produits avec validations.")
@@ -236,6 +458,46 @@ with tab_add:
                 st.session_state.clear_form = True
                 refresh()
 
+    # Import en masse d'une livraison fournisseur (CSV / Excel)
+    with st.expander("📥 Importer une livraison (CSV / Excel)"):
+        st.caption("Colonnes attendues : Désignation, Quantité, Date d'Expiration (AAAA-MM-JJ).")
+        uploaded = st.file_uploader("Fichier fournisseur", type=["csv", "xlsx", "xls"], key="bulk_import_file")
+        if uploaded is not None:
+            try:
+                if uploaded.name.lower().endswith(".csv"):
+                    import_df = pd.read_csv(uploaded, sep=None, engine="python", dtype=str)
+                else:
+                    import_df = pd.read_excel(uploaded, dtype=str)
+            except ImportError:
+                # .xlsx : openpyxl, ancien format .xls : xlrd
+                excel_engine = "xlrd" if uploaded.name.lower().endswith(".xls") else "openpyxl"
+                st.error(f"La lecture de ce fichier Excel nécessite le paquet '{excel_engine}'.")
+                import_df = None
+            except Exception as e:
+                st.error(f"Impossible de lire le fichier : {e}")
+                import_df = None
+
+            if import_df is not None:
+                import_rows, import_errors = parse_import_rows(import_df)
+                for err in import_errors[:20]:
+                    st.error(err)
+                if len(import_errors) > 20:
+                    st.error(f"... et {len(import_errors) - 20} autre(s) erreur(s).")
+
+                if import_rows:
+                    st.dataframe(pd.DataFrame(import_rows), use_container_width=True, hide_index=True, height=240)
+                    if st.button(f"Importer {len(import_rows)} ligne(s)", type="primary", use_container_width=True,
+                                 disabled=bool(import_errors)):
+                        try:
+                            counts = db.add_products_bulk(import_rows)
+                        except Exception as e:
+                            st.error(f"Erreur lors de l'import: {e}")
+                        else:
+                            st.session_state.show_success = (
+                                f"Import terminé : {counts['inserted']} nouveau(x) lot(s), {counts['merged']} fusionné(s)"
+                            )
+                            refresh()
+
 # --------------- Manage Products Tab ---------------
 with tab_manage:
     st.subheader("Liste des produits")
@@ -249,36 +511,76 @@ with tab_manage:
         st.toast(st.session_state.show_delete_success, icon="🗑️")
         del st.session_state.show_delete_success
 
-    rows = db.get_products(search=search)
+    # Vue « Expire bientôt » : parcours de l'index d'expiration, du plus proche au plus lointain
+    manage_view = st.radio("Affichage", ["Tous les produits", "⏰ Expire bientôt"], horizontal=True)
+    expiring_only = manage_view == "⏰ Expire bientôt"
 
-    if not rows:
-        st.info("Aucun produit trouvé ... ")
+    # Pagination keyset : une pile de curseurs permet de revenir en arrière
+    page_cols = st.columns([2, 1, 1, 1])
+    with page_cols[0]:
+        if expiring_only:
+            expiring_days = st.number_input("Expire dans (jours)", min_value=0, max_value=365,
+                                            value=db.EXPIRY_URGENT_DAYS, step=1)
+            sort_column = "expiry_date"
+        else:
+            # Avec une recherche, les noms les plus proches viennent en premier
+            sort_labels = (["Pertinence"] if search else []) + ["Code", "Désignation", "Date d'Expiration"]
+            sort_label = st.selectbox("Trier par", sort_labels)
+            sort_column = {"Pertinence": "relevance", "Code": "id", "Désignation": "name",
+                           "Date d'Expiration": "expiry_date"}[sort_label]
+    with page_cols[1]:
+        page_size = st.selectbox("Produits par page", [25, 50, 100, 250], index=1)
+
+    page_key = (search, sort_column, page_size, expiring_days if expiring_only else None)
+    if st.session_state.get("manage_page_key") != page_key:
+        st.session_state.manage_page_key = page_key
+        st.session_state.manage_cursors = [None]
+    cursors = st.session_state.manage_cursors
+
+    if expiring_only:
+        rows, next_cursor = db.get_expiring(
+            int(expiring_days), limit=page_size, cursor=cursors[-1], search=search
+        )
     else:
-        # Build DataFrame-like structure
-        data = []
-        today = date.today()
-        for r in rows:
-            rid = int(r["id"])  # type: ignore[index]
-            nm = str(r["name"])  # type: ignore[index]
-            qty = int(r["quantity"])  # type: ignore[index]
-            ex = str(r["expiry_date"])  # type: ignore[index]
-            try:
-                y, m, d = map(int, ex.split("-"))
-                ex_d = date(y, m, d)
-                days_left = (ex_d - today).days
-            except Exception:
-                days_left = 0
-            data.append({
-                "Code": rid,
-                "Désignation": nm,
-                "Quantité": qty,
-                "Date d'Expiration": ex,
-                "Jours avant Expiration": days_left,
-            })
+        rows, next_cursor = db.get_products_page(
+            cursor=cursors[-1], page_size=page_size, sort=sort_column, search=search
+        )
+
+    with page_cols[2]:
+        if st.button("◀ Précédent", use_container_width=True, disabled=len(cursors) == 1):
+            cursors.pop()
+            st.rerun()
+    with page_cols[3]:
+        if st.button("Suivant ▶", use_container_width=True, disabled=next_cursor is None):
+            cursors.append(next_cursor)
+            st.rerun()
+    st.caption(f"Page {len(cursors)}")
 
-        import pandas as pd
+    # Bandeau récapitulatif : une requête de comptage sur idx_products_expiry_cover
+    bucket_counts = db.get_expiry_bucket_counts(search)
+    summary_cols = st.columns(3)
+    summary_cols[0].metric("🔴 URGENT (< 30 j)", bucket_counts["URGENT"])
+    summary_cols[1].metric("🟡 À SURVEILLER (30-90 j)", bucket_counts["À SURVEILLER"])
+    summary_cols[2].metric("🟢 EXCELLENT (> 90 j)", bucket_counts["EXCELLENT"])
 
-        df = pd.DataFrame(data)
+    if not rows and expiring_only:
+        st.success(f"Aucun lot n'expire dans les {int(expiring_days)} prochains jours.")
+    elif not rows:
+        st.info("Aucun produit trouvé ... ")
+    else:
+        # Construction colonne par colonne : jours restants et catégorie
+        # d'expiration sont calculés par la base
+        df = pd.DataFrame.from_records(
+            rows, columns=["id", "name", "quantity", "expiry_date", "days_left", "expiry_bucket"]
+        ).rename(columns={
+            "id": "Code",
+            "name": "Désignation",
+            "quantity": "Quantité",
+            "expiry_date": "Date d'Expiration",
+            "days_left": "Jours avant Expiration",
+            "expiry_bucket": "État",
+        })
+        df["Date d'Expiration"] = df["Date d'Expiration"].astype(str)
 
         # Toggle colors
         if "show_colors" not in st.session_state:
@@ -342,58 +644,38 @@ with tab_manage:
                 """, unsafe_allow_html=True)
 
         if st.session_state.show_colors:
-            def color_rows(row):
-                days_left = row["Jours avant Expiration"]
-                if days_left > 90:
-                    color = "background-color: #e8f5e8"  # Vert très clair
-                elif days_left >= 30:  # Entre 30 et 90 jours (inclus)
-                    color = "background-color: #fff8dc"  # Jaune très clair (cornsilk)
-                else:  # < 30 jours
-                    color = "background-color: #ffe4e1"  # Rouge très clair (mistyrose)
-                return [color] * len(row)
-
-            styler = df.style.apply(color_rows, axis=1)
+            # Seule la colonne État est colorée : une règle CSS par ligne au
+            # lieu d'une par cellule de tout le tableau
+            styler = df.style.map(
+                lambda bucket: EXPIRY_BUCKET_COLORS.get(bucket, EXPIRY_BUCKET_COLORS["URGENT"]),
+                subset=["État"],
+            )
             st.dataframe(styler, use_container_width=True, hide_index=True)
         else:
             st.dataframe(df, use_container_width=True, hide_index=True)
 
         # Selection + action buttons
         # Créer des options avec nom + date d'expiration pour différencier les produits
-        options = []
-        product_map = {}
-        
-        # Compter les occurrences de chaque nom de produit
-        name_counts = {}
-        for _, row in df.iterrows():
-            name = row['Désignation']
-            name_counts[name] = name_counts.get(name, 0) + 1
-        
-        # Créer les options d'affichage
-        for _, row in df.iterrows():
-            product_id = int(row['Code'])
-            name = row['Désignation']
-            qty = int(row['Quantité'])
-            exp = str(row["Date d'Expiration"])
-            days_left = row["Jours avant Expiration"]
-            
-            # Si le nom est unique, afficher seulement le nom
-            # Sinon, afficher nom + date d'expiration pour différencier
-            if name_counts[name] == 1:
-                display_label = name
-            else:
-                # Format avec espaces non-sécables pour les produits en doublon
-                display_label = f"{name}\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0→\u00A0\u00A0Exp: {exp}"
-            
-            options.append(display_label)
-            
-            # Stocker toutes les infos du produit
-            product_map[display_label] = {
-                'id': product_id,
-                'name': name,
-                'quantity': qty,
-                'expiry': exp,
-                'days_left': days_left
-            }
+        # Nombre de lots portant le même nom (sur la page affichée)
+        name_counts = df.groupby("Désignation")["Code"].transform("size")
+
+        # Si le nom est unique, afficher seulement le nom
+        # Sinon, afficher nom + date d'expiration pour différencier
+        # (espaces non-sécables pour les produits en doublon)
+        labels = df["Désignation"].where(
+            name_counts == 1,
+            df["Désignation"] + "\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0\u00A0→\u00A0\u00A0Exp: " + df["Date d'Expiration"],
+        )
+        options = labels.tolist()
+
+        # Stocker toutes les infos du produit
+        product_map = dict(zip(options, df.rename(columns={
+            "Code": "id",
+            "Désignation": "name",
+            "Quantité": "quantity",
+            "Date d'Expiration": "expiry",
+            "Jours avant Expiration": "days_left",
+        })[["id", "name", "quantity", "expiry", "days_left"]].to_dict("records")))
 
         selected_label = st.selectbox("Sélectionner un produit :", options, index=0 if options else None)
         selected_product = product_map.get(selected_label)
@@ -401,35 +683,60 @@ with tab_manage:
 
         btn_cols = st.columns([1, 1, 2])
         with btn_cols[0]:
-            if st.button("Modifier", use_container_width=True, disabled=selected_id is None):
-                if selected_product is not None:
-                    edit_product_dialog(
-                        selected_product['id'], 
-                        selected_product['name'], 
-                        selected_product['quantity'], 
-                        selected_product['expiry']
-                    )
+            edit_clicked = st.button("Modifier", use_container_width=True, disabled=selected_id is None)
         with btn_cols[1]:
-            if st.button("Supprimer", use_container_width=True, disabled=selected_id is None):
-                if selected_product is not None:
-                    delete_product_dialog(selected_product['id'], selected_product['name'])
+            delete_clicked = st.button("Supprimer", use_container_width=True, disabled=selected_id is None)
         with btn_cols[2]:
             st.empty()
 
+        # La boîte de dialogue ouverte est gardée en session pour survivre aux
+        # relances de watch_remote_changes (une vente sur un autre poste ne
+        # ferme plus une modification en cours) ; toute autre exécution de la
+        # page signifie qu'elle a été fermée
+        if (edit_clicked or delete_clicked) and selected_product is not None:
+            st.session_state.manage_dialog = ("edit" if edit_clicked else "delete", selected_product)
+        elif not remote_refresh:
+            st.session_state.pop("manage_dialog", None)
+
+        if "manage_dialog" in st.session_state:
+            dialog_kind, dialog_product = st.session_state["manage_dialog"]
+            if dialog_kind == "edit":
+                edit_product_dialog(
+                    dialog_product['id'],
+                    dialog_product['name'],
+                    dialog_product['quantity'],
+                    dialog_product['expiry']
+                )
+            else:
+                delete_product_dialog(dialog_product['id'], dialog_product['name'])
+
 # --------------- Stock Out Tab ---------------
 with tab_stock_out:
     st.subheader("📤 Enregistrer une sortie de stock")
-    st.caption("Sélectionnez un produit et indiquez la quantité à retirer du stock.")
+    st.caption("Ajoutez les produits de la vente au panier, puis enregistrez la sortie en une seule fois.")
     
     # Afficher la notification de succès si elle existe
     if "show_stockout_success" in st.session_state:
         st.toast(st.session_state.show_stockout_success, icon="✅")
         del st.session_state.show_stockout_success
 
-    # Récupérer la liste des produits
-    all_products = db.get_products()
+    # Récupérer la liste des produits (ou seulement les lots qui expirent
+    # bientôt, lus par parcours de l'index d'expiration)
+    expiring_filter = st.checkbox(
+        f"⏰ Expire bientôt (moins de {db.EXPIRY_URGENT_DAYS} jours)",
+        help="Ne proposer que les lots à écouler en priorité.",
+    )
+    if expiring_filter:
+        all_products, expiring_cursor = [], None
+        while True:
+            page, expiring_cursor = db.get_expiring(db.EXPIRY_URGENT_DAYS, limit=500, cursor=expiring_cursor)
+            all_products = all_products + page
+            if expiring_cursor is None:
+                break
+    else:
+        all_products = db.get_products()
     if not all_products:
-        st.info("Aucun produit disponible en stock.")
+        st.info("Aucun lot n'expire bientôt." if expiring_filter else "Aucun produit disponible en stock.")
     else:
         # Préparer les données pour le selectbox avec le même format que la section de gestion
         product_options = []
@@ -461,6 +768,30 @@ with tab_stock_out:
             product_options.append(display_text)
             product_info[display_text] = {"id": pid, "name": name, "qty": qty, "exp": exp}
 
+        # Mode FEFO : un choix par produit, les lots sont pris du plus proche
+        # au plus lointain de l'expiration au moment de l'enregistrement
+        stockout_mode = st.radio(
+            "Mode de sortie",
+            ["Par produit (FEFO)", "Par lot"],
+            horizontal=True,
+            help="FEFO : les lots non périmés qui expirent en premier sortent en premier.",
+        )
+        if stockout_mode == "Par produit (FEFO)":
+            fefo_totals = {}
+            today = date.today()
+            for p in all_products:
+                if p["expiry_date"] >= today:
+                    name = str(p["name"])
+                    total, lots = fefo_totals.get(name, (0, 0))
+                    fefo_totals[name] = (total + int(p["quantity"]), lots + 1)
+
+            product_options = []
+            product_info = {}
+            for name, (total, lots) in fefo_totals.items():
+                display_text = f"{name}  →  Qté: {total}" + (f"  ({lots} lots)" if lots > 1 else "")
+                product_options.append(display_text)
+                product_info[display_text] = {"id": name, "name": name, "qty": total, "exp": "FEFO"}
+
         # Sélection du produit (en dehors du formulaire pour rendre le changement réactif)
         selected_product = st.selectbox(
             "Sélectionner le produit :",
@@ -468,6 +799,11 @@ with tab_stock_out:
             index=0 if product_options else None,
         )
 
+        # Panier de la vente en cours (plusieurs lignes validées en une seule fois)
+        if "stockout_basket" not in st.session_state:
+            st.session_state.stockout_basket = []
+        basket = st.session_state.stockout_basket
+
         # If a stockout is pending confirmation, show confirmation modal
         if "stockout_pending" in st.session_state:
             pending = st.session_state["stockout_pending"]
@@ -476,11 +812,19 @@ with tab_stock_out:
         with st.form("stock_out_form"):
 
             if selected_product:
-                current_stock = product_info[selected_product]["qty"]
+                selected_info = product_info[selected_product]
+                if isinstance(selected_info["id"], str):
+                    in_basket = sum(line["qty"] for line in basket if line["name"] == selected_info["name"])
+                else:
+                    in_basket = sum(line["qty"] for line in basket if line["id"] == selected_info["id"])
+                current_stock = selected_info["qty"] - in_basket
                 
                 # Vérifier si le stock est disponible
                 if current_stock == 0:
-                    st.warning("⚠️ Ce produit n'a plus de stock disponible.")
+                    if in_basket:
+                        st.warning("⚠️ Tout le stock de ce produit est déjà dans le panier.")
+                    else:
+                        st.warning("⚠️ Ce produit n'a plus de stock disponible.")
                 
                 col1, col2 = st.columns(2)
                 with col1:
@@ -513,9 +857,6 @@ with tab_stock_out:
                 # Vérifier si la quantité est valide par rapport au stock
                 is_stock_valid = is_qty_valid and qty_to_remove <= current_stock
 
-                # État du stock après la sortie (si valide)
-                new_stock = current_stock - qty_to_remove if is_stock_valid else current_stock
-
                 # Afficher les messages d'erreur
                 if current_stock > 0:
                     if not is_qty_valid:
@@ -526,33 +867,50 @@ with tab_stock_out:
                         st.error("❌ La quantité doit être supérieure à 0.")
 
                 submitted = st.form_submit_button(
-                    "Enregistrer la sortie",
-                    type="primary",
+                    "🧺 Ajouter au panier",
                     use_container_width=True,
                     disabled=(current_stock == 0 or not is_stock_valid)
                 )
 
-                if submitted:
-                    # Vérification finale avant l'enregistrement (utilisant la validation déjà faite)
-                    if not is_stock_valid:
-                        # Les erreurs sont déjà affichées plus haut
-                        pass
-                    else:
-                        # Store pending confirmation in session_state and rerun to show confirmation panel
-                        detail_msg = reason
-                        if details:
-                            detail_msg += f" - {details}"
-                        st.session_state["stockout_pending"] = {
-                            "id": product_info[selected_product]["id"],
-                            "name": product_info[selected_product]["name"],
-                            "qty": int(qty_to_remove),
-                            "reason": detail_msg,
-                            "details": details,
-                            "current_stock": current_stock,
-                            "new_stock": new_stock,
-                        }
+                if submitted and is_stock_valid:
+                    detail_msg = reason
+                    if details:
+                        detail_msg += f" - {details}"
+                    basket.append({
+                        "id": selected_info["id"],
+                        "name": selected_info["name"],
+                        "exp": selected_info["exp"],
+                        "qty": int(qty_to_remove),
+                        "reason": detail_msg,
+                    })
+                    st.rerun()
+
+        # Contenu du panier
+        if basket:
+            st.markdown(f"#### 🧺 Panier ({len(basket)} ligne(s))")
+            for i, line in enumerate(basket):
+                line_cols = st.columns([3, 1, 2, 1])
+                with line_cols[0]:
+                    st.markdown(f"**{line['name']}**  \n<small>Exp: {line['exp']}</small>", unsafe_allow_html=True)
+                with line_cols[1]:
+                    st.markdown(f"× {line['qty']}")
+                with line_cols[2]:
+                    st.caption(line["reason"])
+                with line_cols[3]:
+                    if st.button("✕", key=f"basket_remove_{i}", use_container_width=True):
+                        basket.pop(i)
                         st.rerun()
 
+            action_cols = st.columns(2)
+            with action_cols[0]:
+                if st.button("✓ Enregistrer la sortie", type="primary", use_container_width=True):
+                    st.session_state["stockout_pending"] = list(basket)
+                    st.rerun()
+            with action_cols[1]:
+                if st.button("🗑️ Vider le panier", use_container_width=True):
+                    st.session_state.stockout_basket = []
+                    st.rerun()
+
 # --------------- History Tab ---------------
 with tab_history:
     st.subheader("📜 Historique des opérations")
@@ -570,21 +928,38 @@ with tab_history:
     with filter_cols[1]:
         limit_records = st.number_input("Nombre d'enregistrements", min_value=10, max_value=500, value=50, step=10)
     with filter_cols[2]:
-        st.empty()
+        export_format = st.selectbox("Format d'export", ["CSV", "Parquet"])
+
+    # Export complet de l'historique : écrit par blocs dans un fichier
+    # temporaire, puis donné au bouton de téléchargement de cette seule
+    # exécution ; rien n'est gardé en session, la prochaine exécution libère
+    # le contenu
+    export_cols = st.columns([1, 1, 2])
+    export_data = None
+    with export_cols[0]:
+        if st.button("📦 Préparer l'export", use_container_width=True, disabled=not central_online):
+            try:
+                export_data = build_history_export(export_format, operation_filters)
+            except ImportError:
+                st.error("L'export Parquet nécessite le paquet 'pyarrow'.")
+            except Exception as e:
+                st.error(f"Erreur lors de l'export : {e}")
+    with export_cols[1]:
+        export_ext = "parquet" if export_format == "Parquet" else "csv"
+        st.download_button(
+            "📥 Télécharger",
+            data=export_data or b"",
+            file_name=f"historique_{date.today().isoformat()}.{export_ext}",
+            mime="application/octet-stream" if export_ext == "parquet" else "text/csv",
+            disabled=export_data is None,
+            use_container_width=True,
+        )
+    if export_data is not None:
+        with export_cols[2]:
+            st.caption("Export prêt : téléchargez-le maintenant, il n'est pas conservé après l'action suivante.")
     
-    # Récupérer l'historique selon les filtres
-    if not operation_filters:  # Si aucun filtre sélectionné, afficher tout
-        history_rows = db.get_history(limit=limit_records)
-    else:
-        # Récupérer les enregistrements pour chaque opération sélectionnée
-        all_history = []
-        for operation in operation_filters:
-            rows = db.get_history_by_operation(operation, limit=limit_records)
-            all_history.extend(rows)
-        
-        # Trier par timestamp décroissant et limiter
-        all_history.sort(key=lambda x: x["timestamp"], reverse=True)  # type: ignore[index]
-        history_rows = all_history[:limit_records]
+    # Récupérer l'historique selon les filtres (une seule requête, vide = tout afficher)
+    history_rows = db.get_history(limit=limit_records, operations=operation_filters or None)
     
     if not history_rows:
         st.info("Aucune opération enregistrée pour le moment.")
@@ -623,24 +998,42 @@ with tab_history:
         history_df = pd.DataFrame(history_data)
         st.dataframe(history_df, use_container_width=True, hide_index=True)
         
-        # Statistiques rapides
+        # Statistiques rapides (cumuls journaliers : historique et archive)
         st.subheader("📊 Statistiques")
-        stats_cols = st.columns(4)
-        
-        total_operations = len(history_rows)
-        ajouts = len([h for h in history_rows if h["operation"] == "AJOUT"])  # type: ignore[index]
-        modifications = len([h for h in history_rows if h["operation"] == "MODIFICATION"])  # type: ignore[index]
-        suppressions = len([h for h in history_rows if h["operation"] == "SUPPRESSION"])  # type: ignore[index]
-        sorties = len([h for h in history_rows if h["operation"] == "SORTIE"])  # type: ignore[index]
-
-        with stats_cols[0]:
-            st.metric("Total opérations", total_operations)
-        with stats_cols[1]:
-            st.metric("➕ Ajouts", ajouts)
-        with stats_cols[2]:
-            st.metric("✏️ Modifications", modifications)
-        with stats_cols[3]:
-            st.metric("📤 Sorties", suppressions + sorties)
+        st.caption("Sur l'ensemble de l'historique, archive comprise, quels que soient les filtres.")
+
+        stats = None
+        if central_online:
+            try:
+                stats = db.get_history_stats()
+            except Exception:
+                pass  # Liaison coupée depuis la dernière synchronisation
+
+        if stats is None:
+            st.info("🟠 Statistiques indisponibles hors ligne : elles seront affichées dès le retour de la connexion.")
+        else:
+            by_operation = stats["by_operation"]
+            stats_cols = st.columns(4)
+            with stats_cols[0]:
+                st.metric("Total opérations", stats["total"])
+            with stats_cols[1]:
+                st.metric("➕ Ajouts", by_operation.get("AJOUT", 0))
+            with stats_cols[2]:
+                st.metric("✏️ Modifications", by_operation.get("MODIFICATION", 0))
+            with stats_cols[3]:
+                st.metric("📤 Sorties", by_operation.get("SUPPRESSION", 0) + by_operation.get("SORTIE", 0))
+
+            # Activité quotidienne sur 30 jours (comptes agrégés par la base)
+            if st.checkbox("Afficher l'activité des 30 derniers jours"):
+                daily = db.get_history_stats(since=(date.today() - timedelta(days=29)).isoformat(), per_day=True)["per_day"]
+                if daily:
+                    daily_df = pd.DataFrame(daily).pivot(index="day", columns="operation", values="count").fillna(0)
+                    st.bar_chart(daily_df)
+                else:
+                    st.info("Aucune opération sur les 30 derniers jours.")
+
+# Bilan des requêtes de cette exécution (affiché par le panneau d'administration)
+st.session_state.last_run_db_metrics = db.end_request_metrics()
 
 # --------------- Backup automatique en arrière-plan ---------------
 # Le système de backup fonctionne automatiquement sans interface utilisateur
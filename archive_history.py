@@ -0,0 +1,44 @@
+"""
+Archivage de l'historique des mouvements
+
+Déplace les lignes de history plus anciennes que la durée de rétention vers
+history_archive, par petits lots (transactions courtes), puis supprime les
+partitions mensuelles vidées. À planifier chaque nuit (Planificateur de
+tâches Windows ou cron), l'application peut rester ouverte pendant ce temps.
+
+Exemples :
+    python archive_history.py                  # HISTORY_RETENTION_DAYS (365 j par défaut)
+    python archive_history.py --days 730 --batch 2000
+    python archive_history.py --max-batches 10 # étaler le travail sur plusieurs nuits
+"""
+import argparse
+import sys
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Archivage des mouvements anciens de l'historique")
+    parser.add_argument("--days", type=int, help="Âge minimal (jours) des lignes archivées")
+    parser.add_argument("--batch", type=int, help="Nombre de lignes par transaction")
+    parser.add_argument("--max-batches", type=int, help="Nombre maximal de lots pour cette exécution")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    import db
+
+    days = db.HISTORY_RETENTION_DAYS if args.days is None else args.days
+    print(f"Archivage des mouvements de plus de {days} jours...")
+    started = time.perf_counter()
+    db.init_db()
+    result = db.archive_history(older_than_days=args.days, batch_size=args.batch, max_batches=args.max_batches)
+    print(f"{result['archived']} ligne(s) archivée(s) en {result['batches']} lot(s), "
+          f"{time.perf_counter() - started:.1f} s")
+    for name in result["dropped_partitions"]:
+        print(f"  - partition vide supprimée : {name}")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
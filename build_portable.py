@@ -38,6 +38,7 @@ def build_simple_executable():
         "--add-data", "app.py;.",
         "--add-data", "db.py;.",
         "--add-data", "utils.py;.",
+        "--add-data", "local_replica.py;.",
         "--hidden-import", "streamlit",
         "--hidden-import", "pandas",
         "--hidden-import", "sqlite3",
@@ -26,6 +26,7 @@ def create_portable_package():
         'app.py',
         'db.py', 
         'utils.py',
+        'local_replica.py',
         'desktop_portable.py'
     ]
     
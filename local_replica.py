@@ -0,0 +1,916 @@
+"""Réplique locale SQLite de la base centrale (fonctionnement hors ligne).
+
+Activée par LOCAL_REPLICA=1 (.env ou database_config.txt) puis démarrée par
+``start_local_replica()``. Les fonctions de db.py décorées par ``_replicated``
+sont alors servies par ce module : les lectures viennent du fichier SQLite,
+les écritures y sont appliquées immédiatement et consignées dans un journal
+qu'un thread de synchronisation rejoue sur PostgreSQL, dans l'ordre, avant
+de rapatrier les modifications des autres postes (delta par ``updated_at``).
+
+Chaque opération rejouée est enregistrée dans ``replica_applied`` dans la
+même transaction : si la réponse se perd, le rejeu suivant est ignoré.
+
+Règles de conflit :
+- ajout : fusion additive (upsert), jamais en conflit ;
+- modification : la dernière modification synchronisée l'emporte ;
+- suppression d'un lot déjà supprimé ailleurs : ignorée ;
+- sortie de stock refusée par la base centrale (un autre poste a vendu le
+  même lot entre-temps) : la marchandise est déjà sortie, donc on retire ce
+  qui reste disponible et l'écart est noté dans ``sync_conflicts`` pour
+  régularisation ;
+- toute autre opération refusée (lot introuvable, doublon nom/date...) est
+  abandonnée et notée dans ``sync_conflicts``.
+
+L'historique local ne garde que les LOCAL_REPLICA_HISTORY_ROWS dernières
+lignes : les statistiques et l'export complet restent lus sur la base centrale.
+"""
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from sqlalchemy import exc, text
+
+import db
+
+REPLICA_PATH = db.get_setting(
+    "LOCAL_REPLICA_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "pharmacie_replica.db")
+)
+SYNC_INTERVAL_SECONDS = float(db.get_setting("LOCAL_REPLICA_SYNC_SECONDS", "10"))
+HISTORY_ROWS = int(db.get_setting("LOCAL_REPLICA_HISTORY_ROWS", "5000"))
+
+# Erreurs signifiant « base centrale injoignable » : le journal est conservé
+_OFFLINE_ERRORS = (exc.OperationalError, exc.InterfaceError, exc.TimeoutError, exc.DisconnectionError)
+# Refus métier d'une opération rejouée : elle est abandonnée et notée en conflit
+_REJECTED_ERRORS = (ValueError, exc.IntegrityError, exc.DataError)
+_STOCKOUT_OPERATIONS = ("remove_stock_many", "remove_stock_by_name")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    expiry_date TEXT NOT NULL,
+    created_at TEXT,
+    updated_at TEXT,
+    UNIQUE (name, expiry_date)
+);
+CREATE INDEX IF NOT EXISTS idx_products_name_id ON products(name, id);
+CREATE INDEX IF NOT EXISTS idx_products_expiry_id ON products(expiry_date, id);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    operation TEXT NOT NULL,
+    product_id INTEGER,
+    product_name TEXT,
+    old_quantity INTEGER,
+    new_quantity INTEGER,
+    old_expiry_date TEXT,
+    new_expiry_date TEXT,
+    timestamp TEXT NOT NULL,
+    details TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp);
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS id_map (
+    local_id INTEGER PRIMARY KEY,
+    remote_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_conflicts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    message TEXT NOT NULL,
+    acknowledged INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_PRODUCT_COLUMNS = ("id", "name", "quantity", "expiry_date", "created_at", "updated_at")
+_HISTORY_COLUMNS = (
+    "id", "operation", "product_id", "product_name", "old_quantity", "new_quantity",
+    "old_expiry_date", "new_expiry_date", "timestamp", "details",
+)
+_DATE_COLUMNS = ("expiry_date", "old_expiry_date", "new_expiry_date")
+_TIMESTAMP_COLUMNS = ("created_at", "updated_at", "timestamp")
+
+_ready = False
+_online: Optional[bool] = None
+_last_sync: Optional[datetime] = None
+_last_error: Optional[str] = None
+_state_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_sync_thread: Optional[threading.Thread] = None
+_sync_stop = threading.Event()
+_sync_wake = threading.Event()
+
+
+# --------------- Accès SQLite ---------------
+
+@contextmanager
+def _connect(write: bool = False) -> Iterator[sqlite3.Connection]:
+    """Connexion SQLite ; ``write`` ouvre une transaction BEGIN IMMEDIATE."""
+    conn = sqlite3.connect(REPLICA_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        if write:
+            conn.execute("BEGIN IMMEDIATE")
+        yield conn
+        if write:
+            conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def _get_meta(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(conn: sqlite3.Connection, key: str, value: Any) -> None:
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+def _next_local_id(conn: sqlite3.Connection, key: str) -> int:
+    """Identifiant provisoire (négatif) d'une ligne créée hors ligne."""
+    value = int(_get_meta(conn, key) or 0) - 1
+    _set_meta(conn, key, value)
+    return value
+
+
+def _ts(value: datetime) -> str:
+    # Format fixe en UTC : l'ordre des chaînes est l'ordre chronologique
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+
+def _now() -> str:
+    return _ts(datetime.now(timezone.utc))
+
+
+def _iso_date(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()[:10]
+    return str(value)
+
+
+def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    """Ligne SQLite -> dict aux types de db.py (date, datetime)."""
+    result = dict(row)
+    for column in _DATE_COLUMNS:
+        if result.get(column) is not None:
+            result[column] = date.fromisoformat(result[column])
+    for column in _TIMESTAMP_COLUMNS:
+        if result.get(column) is not None:
+            result[column] = datetime.fromisoformat(result[column])
+    return result
+
+
+def _remote_values(row: Dict[str, Any], columns: Tuple[str, ...]) -> Tuple[Any, ...]:
+    """Ligne PostgreSQL -> valeurs à insérer dans SQLite."""
+    values = []
+    for column in columns:
+        value = row.get(column)
+        if column in _DATE_COLUMNS:
+            value = _iso_date(value)
+        elif column in _TIMESTAMP_COLUMNS and value is not None:
+            value = _ts(value)
+        values.append(value)
+    return tuple(values)
+
+
+# --------------- Écritures locales ---------------
+
+def _history(conn: sqlite3.Connection, operation: str, product_id: int, name: str,
+             old_qty: Optional[int], new_qty: Optional[int],
+             old_exp: Optional[str], new_exp: Optional[str], details: str) -> None:
+    conn.execute(
+        "INSERT INTO history (id, operation, product_id, product_name, old_quantity, new_quantity, "
+        "old_expiry_date, new_expiry_date, timestamp, details) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (_next_local_id(conn, "next_history_id"), operation, product_id, name,
+         old_qty, new_qty, old_exp, new_exp, _now(), details),
+    )
+
+
+def _journal(conn: sqlite3.Connection, operation: str, payload: Dict[str, Any]) -> None:
+    conn.execute(
+        "INSERT INTO journal (created_at, operation, payload) VALUES (?, ?, ?)",
+        (_now(), operation, json.dumps(payload)),
+    )
+
+
+def _upsert_lot(conn: sqlite3.Connection, name: str, qty: int, exp: str) -> Tuple[int, bool]:
+    """Ajoute ou fusionne un lot comme l'upsert de db.add_product ; (id, inséré)."""
+    row = conn.execute(
+        "SELECT id, quantity FROM products WHERE name = ? AND expiry_date = ?", (name, exp)
+    ).fetchone()
+    now = _now()
+    if row is None:
+        product_id = _next_local_id(conn, "next_product_id")
+        conn.execute(
+            "INSERT INTO products (id, name, quantity, expiry_date, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (product_id, name, qty, exp, now, now),
+        )
+        _history(conn, "AJOUT", product_id, name, None, qty, None, exp,
+                 f"Produit ajouté: {name} (Qté: {qty}, Exp: {exp})")
+        return product_id, True
+
+    product_id, old_qty = int(row[0]), int(row[1])
+    conn.execute(
+        "UPDATE products SET quantity = quantity + ?, updated_at = ? WHERE id = ?", (qty, now, product_id)
+    )
+    _history(conn, "AJOUT", product_id, name, old_qty, old_qty + qty, exp, exp,
+             f"Produit ajouté (fusion): {name} (Qté précédente: {old_qty}, +{qty}) - Exp: {exp}")
+    return product_id, False
+
+
+def _take(conn: sqlite3.Connection, lot: sqlite3.Row, qty: int, suffix: str) -> int:
+    """Retire ``qty`` d'un lot (supprimé s'il est épuisé) ; retourne le reste."""
+    remaining = int(lot["quantity"]) - qty
+    if remaining == 0:
+        conn.execute("DELETE FROM products WHERE id = ?", (lot["id"],))
+        details = f"🔴 Sortie de stock finale: {lot['name']} (-{qty}) - STOCK ÉPUISÉ - Produit supprimé"
+    else:
+        conn.execute(
+            "UPDATE products SET quantity = ?, updated_at = ? WHERE id = ?", (remaining, _now(), lot["id"])
+        )
+        details = f"Sortie de stock: {lot['name']} (-{qty})"
+    _history(conn, "SORTIE", int(lot["id"]), lot["name"], int(lot["quantity"]), remaining,
+             lot["expiry_date"], lot["expiry_date"], f"{details}{suffix} - Exp: {lot['expiry_date']}")
+    return remaining
+
+
+def _remove_by_ids(conn: sqlite3.Connection, lines: List[Tuple[int, int, str]]) -> Dict[int, int]:
+    requested: Dict[int, int] = {}
+    reasons: Dict[int, List[str]] = {}
+    for product_id, quantity, reason in lines:
+        if quantity <= 0:
+            raise ValueError("La quantité à retirer doit être positive")
+        requested[int(product_id)] = requested.get(int(product_id), 0) + int(quantity)
+        if reason and reason not in reasons.setdefault(int(product_id), []):
+            reasons[int(product_id)].append(reason)
+
+    lots = {}
+    for product_id, quantity in requested.items():
+        lot = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
+        if lot is None:
+            raise ValueError(f"Produit non trouvé (id: {product_id})")
+        if int(lot["quantity"]) < quantity:
+            raise db.InsufficientStockError(product_id, int(lot["quantity"]), quantity)
+        lots[product_id] = lot
+
+    remaining = {}
+    for product_id, quantity in requested.items():
+        motif = reasons.get(product_id)
+        suffix = f" - Motif: {', '.join(sorted(motif))}" if motif else ""
+        remaining[product_id] = _take(conn, lots[product_id], quantity, suffix)
+    return remaining
+
+
+def _remove_by_name(conn: sqlite3.Connection, name: str, quantity: int, reason: str,
+                    include_expired: bool) -> Dict[int, int]:
+    if quantity <= 0:
+        raise ValueError("La quantité à retirer doit être positive")
+    nm = name.strip()
+    lots = conn.execute(
+        "SELECT * FROM products WHERE name = ? AND (? OR expiry_date >= ?) ORDER BY expiry_date, id",
+        (nm, int(bool(include_expired)), date.today().isoformat()),
+    ).fetchall()
+    available = sum(int(lot["quantity"]) for lot in lots)
+    if not available:
+        raise ValueError(f"Produit non trouvé ou sans lot valide : {nm}")
+    if available < quantity:
+        raise db.InsufficientStockError(None, available, int(quantity), name=nm)
+
+    suffix = " [FEFO]" + (f" - Motif: {reason}" if reason else "")
+    remaining: Dict[int, int] = {}
+    left = int(quantity)
+    for lot in lots:
+        if left <= 0:
+            break
+        take = min(left, int(lot["quantity"]))
+        remaining[int(lot["id"])] = _take(conn, lot, take, suffix)
+        left -= take
+    return remaining
+
+
+def add_product(name: str, quantity: int, expiry_date: str) -> int:
+    nm = name.strip()
+    qty = int(quantity)
+    if qty < 0:
+        raise ValueError(f"Quantité négative pour {nm}")
+    exp = _iso_date(expiry_date)
+    with _connect(write=True) as conn:
+        product_id, _ = _upsert_lot(conn, nm, qty, exp)
+        _journal(conn, "add_product", {"name": nm, "quantity": qty, "expiry_date": exp, "local_id": product_id})
+    _sync_wake.set()
+    return product_id
+
+
+def add_products_bulk(rows: Iterable[Dict[str, Any]]) -> Dict[str, int]:
+    lots: Dict[Tuple[str, str], int] = {}
+    for row in rows:
+        qty = int(row["quantity"])
+        if qty < 0:
+            raise ValueError(f"Quantité négative pour {row['name']}")
+        key = (str(row["name"]).strip(), _iso_date(row["expiry_date"]))
+        lots[key] = lots.get(key, 0) + qty
+
+    if not lots:
+        return {"inserted": 0, "merged": 0}
+
+    inserted = 0
+    journal_rows = []
+    with _connect(write=True) as conn:
+        for (name, exp), qty in lots.items():
+            local_id, was_inserted = _upsert_lot(conn, name, qty, exp)
+            inserted += was_inserted
+            journal_rows.append({"name": name, "quantity": qty, "expiry_date": exp, "local_id": local_id})
+        _journal(conn, "add_products_bulk", {"rows": journal_rows})
+    _sync_wake.set()
+    return {"inserted": inserted, "merged": len(lots) - inserted}
+
+
+def update_product(product_id: int, name: str, quantity: int, expiry_date: str) -> None:
+    nm = name.strip()
+    exp = _iso_date(expiry_date)
+    with _connect(write=True) as conn:
+        old = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
+        if old is None:
+            return
+        conn.execute(
+            "UPDATE products SET name = ?, quantity = ?, expiry_date = ?, updated_at = ? WHERE id = ?",
+            (nm, quantity, exp, _now(), product_id),
+        )
+        details_parts = []
+        if old["name"] != nm:
+            details_parts.append(f"Nom: {old['name']} → {nm}")
+        if old["quantity"] != quantity:
+            details_parts.append(f"Qté: {old['quantity']} → {quantity}")
+        if old["expiry_date"] != exp:
+            details_parts.append(f"Exp: {old['expiry_date']} → {exp}")
+        details = f"Produit modifié: {nm}" + (f" ({', '.join(details_parts)})" if details_parts else "")
+        _history(conn, "MODIFICATION", product_id, nm, old["quantity"], quantity, old["expiry_date"], exp, details)
+        _journal(conn, "update_product", {
+            "product_id": product_id, "name": nm, "quantity": quantity, "expiry_date": exp,
+        })
+    _sync_wake.set()
+
+
+def delete_product(product_id: int) -> None:
+    with _connect(write=True) as conn:
+        old = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
+        if old is None:
+            return
+        conn.execute("DELETE FROM products WHERE id = ?", (product_id,))
+        _history(conn, "SUPPRESSION", product_id, old["name"], old["quantity"], None, old["expiry_date"], None,
+                 f"Produit supprimé: {old['name']} (Qté: {old['quantity']}, Exp: {old['expiry_date']})")
+        _journal(conn, "delete_product", {"product_id": product_id})
+    _sync_wake.set()
+
+
+def remove_stock(product_id: int, quantity: int, reason: str = "") -> int:
+    return remove_stock_many([(product_id, quantity, reason)])[int(product_id)]
+
+
+def remove_stock_by_name(name: str, quantity: int, reason: str = "", include_expired: bool = False) -> Dict[int, int]:
+    with _connect(write=True) as conn:
+        remaining = _remove_by_name(conn, name, quantity, reason, include_expired)
+        _journal(conn, "remove_stock_by_name", {
+            "name": name.strip(), "quantity": int(quantity), "reason": reason or "",
+            "include_expired": bool(include_expired),
+        })
+    _sync_wake.set()
+    return remaining
+
+
+def remove_stock_many(lines: List[Tuple[Union[int, str], int, str]]) -> Dict[int, int]:
+    if not lines:
+        return {}
+    by_id = [line for line in lines if not isinstance(line[0], str)]
+    by_name = [line for line in lines if isinstance(line[0], str)]
+
+    with _connect(write=True) as conn:
+        remaining = _remove_by_ids(conn, by_id) if by_id else {}
+        for name, quantity, reason in by_name:
+            remaining.update(_remove_by_name(conn, name, quantity, reason, False))
+        _journal(conn, "remove_stock_many", {
+            "lines": [[product, int(quantity), reason or ""] for product, quantity, reason in lines]
+        })
+    _sync_wake.set()
+    return remaining
+
+
+# --------------- Lectures locales ---------------
+
+# Mêmes colonnes calculées que db._EXPIRY_COLUMNS (paramètres : _expiry_limits())
+_EXPIRY_COLUMNS = (
+    "CAST(julianday(expiry_date) - julianday(?) AS INTEGER) AS days_left, "
+    "CASE WHEN expiry_date < ? THEN 'URGENT' WHEN expiry_date <= ? THEN 'À SURVEILLER' "
+    "ELSE 'EXCELLENT' END AS expiry_bucket"
+)
+
+
+def _expiry_limits() -> Tuple[str, str, str]:
+    """Aujourd'hui et les seuils URGENT / À SURVEILLER en dates ISO."""
+    today = date.today()
+    return (
+        today.isoformat(),
+        (today + timedelta(days=db.EXPIRY_URGENT_DAYS)).isoformat(),
+        (today + timedelta(days=db.EXPIRY_WATCH_DAYS)).isoformat(),
+    )
+
+
+def get_products(search: Optional[str] = None) -> List[Dict[str, Any]]:
+    with _connect() as conn:
+        if search:
+            rows = conn.execute(
+                "SELECT * FROM products WHERE name LIKE ? ORDER BY id ASC", (f"%{search.strip()}%",)
+            ).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM products ORDER BY id ASC").fetchall()
+    return [_to_dict(row) for row in rows]
+
+
+def get_products_page(
+    cursor: Optional[Tuple[Any, int]] = None,
+    page_size: int = 50,
+    sort: str = "id",
+    search: Optional[str] = None,
+    descending: bool = False,
+) -> Tuple[List[Dict[str, Any]], Optional[Tuple[Any, int]]]:
+    if sort not in db.PAGE_SORT_COLUMNS:
+        raise ValueError(f"Colonne de tri invalide: {sort}")
+    if sort == "relevance" and not search:
+        raise ValueError("Le tri par pertinence nécessite une recherche")
+    if page_size <= 0:
+        raise ValueError("La taille de page doit être positive")
+
+    # Pas de similarité trigramme en SQLite : score constant, ordre des id
+    columns = f"*, {_EXPIRY_COLUMNS}"
+    sort_key = sort
+    if sort == "relevance":
+        descending = not descending
+        sort_key = "1.0"
+        columns += ", 1.0 AS relevance"
+    clauses = []
+    params: List[Any] = []
+    if search:
+        clauses.append("name LIKE ?")
+        params.append(f"%{search.strip()}%")
+    if cursor is not None:
+        last_key, last_id = cursor
+        clauses.append(f"({sort_key}, id) {'<' if descending else '>'} (?, ?)")
+        params += [_iso_date(last_key) if sort == "expiry_date" else last_key, last_id]
+
+    where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+    order = "DESC" if descending else "ASC"
+    with _connect() as conn:
+        rows = [_to_dict(row) for row in conn.execute(
+            f"SELECT {columns} FROM products {where}ORDER BY {sort_key} {order}, id {order} LIMIT ?",
+            list(_expiry_limits()) + params + [int(page_size) + 1],
+        )]
+
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    return rows, (rows[-1][sort], rows[-1]["id"])
+
+
+def get_expiry_bucket_counts(search: Optional[str] = None) -> Dict[str, int]:
+    today, urgent, watch = _expiry_limits()
+    where = "name LIKE ? AND " if search else ""
+    params = [f"%{search.strip()}%"] if search else []
+    with _connect() as conn:
+        row = conn.execute(
+            f"SELECT (SELECT COUNT(*) FROM products WHERE {where}expiry_date < ?), "
+            f"(SELECT COUNT(*) FROM products WHERE {where}expiry_date >= ? AND expiry_date <= ?), "
+            f"(SELECT COUNT(*) FROM products WHERE {where}expiry_date > ?)",
+            params + [urgent] + params + [urgent, watch] + params + [watch],
+        ).fetchone()
+    return {bucket: int(count) for bucket, count in zip(db.EXPIRY_BUCKETS, row)}
+
+
+def get_expiring(
+    days: int = db.EXPIRY_URGENT_DAYS,
+    limit: int = 100,
+    cursor: Optional[Tuple[Any, int]] = None,
+    include_expired: bool = True,
+    search: Optional[str] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[Tuple[Any, int]]]:
+    if days < 0:
+        raise ValueError("Le nombre de jours doit être positif")
+    if limit <= 0:
+        raise ValueError("La limite doit être positive")
+
+    limits = _expiry_limits()
+    clauses = ["expiry_date <= ?"]
+    params: List[Any] = [(date.today() + timedelta(days=int(days))).isoformat()]
+    if not include_expired:
+        clauses.append("expiry_date >= ?")
+        params.append(limits[0])
+    if search:
+        clauses.append("name LIKE ?")
+        params.append(f"%{search.strip()}%")
+    if cursor is not None:
+        clauses.append("(expiry_date, id) > (?, ?)")
+        params += [_iso_date(cursor[0]), cursor[1]]
+
+    with _connect() as conn:
+        rows = [_to_dict(row) for row in conn.execute(
+            f"SELECT id, name, quantity, expiry_date, {_EXPIRY_COLUMNS} FROM products "
+            f"WHERE {' AND '.join(clauses)} ORDER BY expiry_date, id LIMIT ?",
+            list(limits) + params + [int(limit) + 1],
+        )]
+
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1]["expiry_date"], rows[-1]["id"])
+
+
+def get_product_by_id(product_id: int) -> Optional[Dict[str, Any]]:
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
+    return _to_dict(row) if row else None
+
+
+def get_history(limit: Optional[int] = 100, operations: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    query = "SELECT * FROM history"
+    params: List[Any] = []
+    if operations:
+        query += f" WHERE operation IN ({', '.join('?' for _ in operations)})"
+        params += list(operations)
+    query += " ORDER BY timestamp DESC"
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    with _connect() as conn:
+        return [_to_dict(row) for row in conn.execute(query, params)]
+
+
+# --------------- Synchronisation ---------------
+
+def _claim(conn, replica_id: str, seq: int) -> bool:
+    """Réserve l'entrée du journal côté central ; False si elle a déjà été rejouée."""
+    return conn.execute(text(
+        "INSERT INTO replica_applied (replica_id, seq) VALUES (:replica_id, :seq) "
+        "ON CONFLICT DO NOTHING RETURNING seq"
+    ), {"replica_id": replica_id, "seq": seq}).fetchone() is not None
+
+
+def _translate(product: Any, id_map: Dict[int, int]) -> Any:
+    """Remplace un id provisoire (négatif) par l'id central.
+
+    Raises:
+        ValueError: si le lot n'a pas d'id central (son ajout a été refusé)
+    """
+    if isinstance(product, str) or product >= 0:
+        return product
+    if product not in id_map:
+        raise ValueError(f"Lot local jamais synchronisé (id provisoire: {product})")
+    return id_map[product]
+
+
+def _apply_remote(conn, operation: str, payload: Dict[str, Any], id_map: Dict[int, int]) -> None:
+    if operation == "add_product":
+        db._add_product(conn, payload["name"], payload["quantity"], payload["expiry_date"])
+    elif operation == "add_products_bulk":
+        db._add_products_bulk(conn, [
+            {"name": row["name"], "quantity": row["quantity"], "expiry_date": row["expiry_date"]}
+            for row in payload["rows"]
+        ])
+    elif operation == "update_product":
+        db._update_product(conn, _translate(payload["product_id"], id_map), payload["name"],
+                           payload["quantity"], payload["expiry_date"])
+    elif operation == "delete_product":
+        db._delete_product(conn, _translate(payload["product_id"], id_map))
+    elif operation == "remove_stock_by_name":
+        db._remove_stock_by_name(conn, payload["name"], payload["quantity"], payload["reason"],
+                                 payload["include_expired"])
+    elif operation == "remove_stock_many":
+        db._remove_stock_many(conn, [(_translate(p, id_map), q, r) for p, q, r in payload["lines"]])
+    else:
+        raise ValueError(f"Opération de journal inconnue: {operation}")
+
+
+def _resolve_stockout(conn, operation: str, payload: Dict[str, Any], id_map: Dict[int, int]) -> List[str]:
+    """Rejoue une sortie refusée ligne par ligne en retirant ce qui reste disponible."""
+    if operation == "remove_stock_by_name":
+        lines = [(payload["name"], payload["quantity"], payload["reason"])]
+        include_expired = payload["include_expired"]
+    else:
+        lines = payload["lines"]
+        include_expired = False
+
+    def remove(product: Any, quantity: int, reason: str) -> None:
+        if isinstance(product, str):
+            db._remove_stock_by_name(conn, product, quantity, reason, include_expired)
+        else:
+            db._remove_stock(conn, [(_translate(product, id_map), quantity, reason)])
+
+    messages = []
+    for product, quantity, reason in lines:
+        savepoint = conn.begin_nested()
+        try:
+            remove(product, quantity, reason)
+            savepoint.commit()
+            continue
+        except db.InsufficientStockError as error:
+            savepoint.rollback()
+            shortfall = error
+        except ValueError as error:
+            savepoint.rollback()
+            messages.append(f"Sortie non enregistrée ({product}, -{quantity}) : {error}")
+            continue
+
+        if shortfall.available > 0:
+            savepoint = conn.begin_nested()
+            remove(product, shortfall.available, f"{reason} [sync: sortie partielle]".strip())
+            savepoint.commit()
+        messages.append(
+            f"Sortie partielle ({shortfall.name or product}) : {quantity} demandé(s), "
+            f"{shortfall.available} disponible(s), écart de {quantity - shortfall.available}"
+        )
+    return messages
+
+
+def _remote_lot_ids(conn, operation: str, payload: Dict[str, Any]) -> List[Tuple[int, int]]:
+    """(id provisoire, id central) des lots créés hors ligne qu'un ajout vient de rejouer.
+
+    L'id provisoire vient du journal : le lot local a pu être renommé ou
+    épuisé depuis, sa clé (name, expiry_date) actuelle ne le retrouve plus.
+    """
+    rows = payload["rows"] if operation == "add_products_bulk" else [payload]
+    rows = [row for row in rows if row.get("local_id", 0) < 0]
+    if not rows:
+        return []
+    result = conn.execute(text(
+        "SELECT t.local_id, p.id FROM products p "
+        "JOIN unnest(CAST(:names AS text[]), CAST(:exps AS date[]), CAST(:local_ids AS int[])) "
+        "AS t(name, expiry_date, local_id) "
+        "ON p.name = t.name AND p.expiry_date = t.expiry_date"
+    ), {
+        "names": [row["name"] for row in rows],
+        "exps": [row["expiry_date"] for row in rows],
+        "local_ids": [row["local_id"] for row in rows],
+    })
+    return [(int(local_id), int(remote_id)) for local_id, remote_id in result]
+
+
+def _push() -> int:
+    """Rejoue le journal dans l'ordre ; retourne le nombre d'entrées traitées."""
+    done = 0
+    while True:
+        with _connect() as lconn:
+            entry = lconn.execute("SELECT seq, operation, payload FROM journal ORDER BY seq LIMIT 1").fetchone()
+            replica_id = _get_meta(lconn, "replica_id")
+            id_map = dict(lconn.execute("SELECT local_id, remote_id FROM id_map").fetchall())
+        if entry is None:
+            return done
+
+        seq, operation = int(entry["seq"]), entry["operation"]
+        payload = json.loads(entry["payload"])
+        conflicts: List[str] = []
+        lots: List[Tuple[int, int]] = []
+        with db.get_connection() as conn:
+            if _claim(conn, replica_id, seq):
+                savepoint = conn.begin_nested()
+                try:
+                    _apply_remote(conn, operation, payload, id_map)
+                    savepoint.commit()
+                except _REJECTED_ERRORS as error:
+                    savepoint.rollback()
+                    if operation in _STOCKOUT_OPERATIONS and isinstance(error, ValueError):
+                        # Les autres lignes de la vente sont bien sorties
+                        conflicts = _resolve_stockout(conn, operation, payload, id_map)
+                    else:
+                        conflicts = [str(error)]
+                if operation in ("add_product", "add_products_bulk"):
+                    lots = _remote_lot_ids(conn, operation, payload)
+
+        # La transaction centrale est validée : si la suite échoue, l'entrée
+        # reste au journal et son rejeu sera ignoré grâce à _claim.
+        with _connect(write=True) as lconn:
+            lconn.executemany("INSERT OR REPLACE INTO id_map (local_id, remote_id) VALUES (?, ?)", lots)
+            for message in conflicts:
+                lconn.execute(
+                    "INSERT INTO sync_conflicts (created_at, operation, payload, message) VALUES (?, ?, ?, ?)",
+                    (_now(), operation, entry["payload"], message),
+                )
+            lconn.execute("DELETE FROM journal WHERE seq = ?", (seq,))
+        done += 1
+
+
+def _pull() -> bool:
+    """Rapatrie les produits modifiés et le nouvel historique ; True si quelque chose a changé."""
+    with _connect() as lconn:
+        as_of = _get_meta(lconn, "products_as_of")
+        last_history_id = _get_meta(lconn, "last_history_id")
+
+    delta = db.get_products_changed_since(datetime.fromisoformat(as_of) if as_of else None)
+    with db.get_connection() as conn:
+        if last_history_id is None:
+            history = conn.execute(text(
+                "SELECT * FROM (SELECT * FROM history ORDER BY id DESC LIMIT :limit) recent ORDER BY id"
+            ), {"limit": HISTORY_ROWS})
+        else:
+            # Même marge de recouvrement que les produits pour les transactions lentes
+            history = conn.execute(text(
+                "SELECT * FROM history WHERE id > :last_id OR timestamp >= :since ORDER BY id"
+            ), {"last_id": int(last_history_id), "since": datetime.fromisoformat(as_of)})
+        history_rows = [dict(row._mapping) for row in history]
+
+    with _connect(write=True) as lconn:
+        # Des écritures locales ont eu lieu pendant la lecture : elles ne sont
+        # pas encore dans la base centrale, on attend le prochain passage.
+        if lconn.execute("SELECT 1 FROM journal LIMIT 1").fetchone():
+            return False
+        if delta["full"]:
+            lconn.execute("DELETE FROM products")
+        # Les lots provisoires reviennent de la base centrale avec leur vrai id
+        lconn.execute("DELETE FROM products WHERE id < 0")
+        lconn.executemany("DELETE FROM products WHERE id = ?", [(pid,) for pid in delta["deleted"]])
+        # REPLACE écrase aussi une ligne qui occuperait le même (nom, date)
+        lconn.executemany(
+            f"INSERT OR REPLACE INTO products ({', '.join(_PRODUCT_COLUMNS)}) "
+            f"VALUES ({', '.join('?' for _ in _PRODUCT_COLUMNS)})",
+            [_remote_values(row, _PRODUCT_COLUMNS) for row in delta["changed"]],
+        )
+
+        lconn.execute("DELETE FROM history WHERE id < 0")
+        lconn.executemany(
+            f"INSERT OR REPLACE INTO history ({', '.join(_HISTORY_COLUMNS)}) "
+            f"VALUES ({', '.join('?' for _ in _HISTORY_COLUMNS)})",
+            [_remote_values(row, _HISTORY_COLUMNS) for row in history_rows],
+        )
+        lconn.execute(
+            "DELETE FROM history WHERE id NOT IN (SELECT id FROM history ORDER BY id DESC LIMIT ?)",
+            (HISTORY_ROWS,),
+        )
+
+        _set_meta(lconn, "products_as_of", _ts(delta["as_of"]))
+        if history_rows:
+            _set_meta(lconn, "last_history_id", max(int(row["id"]) for row in history_rows))
+        elif last_history_id is None:
+            _set_meta(lconn, "last_history_id", 0)
+    return bool(delta["full"] or delta["changed"] or delta["deleted"] or history_rows)
+
+
+def sync_now() -> bool:
+    """Pousse le journal puis rapatrie les changements ; False si la base centrale est injoignable."""
+    global _ready, _online, _last_sync, _last_error
+    with _sync_lock:
+        try:
+            db.init_db()  # une seule fois par processus, dès que la base répond
+            pushed = _push()
+            pulled = _pull()
+        except _OFFLINE_ERRORS as error:
+            with _state_lock:
+                _online = False
+                _last_error = str(getattr(error, "orig", None) or error)
+            return False
+
+        with _state_lock:
+            _online = True
+            _last_sync = datetime.now()
+            _last_error = None
+            if not _ready:
+                with _connect() as lconn:
+                    _ready = _get_meta(lconn, "products_as_of") is not None
+        if pushed or pulled:
+            db.bump_data_version()
+        return True
+
+
+def _sync_loop() -> None:
+    global _last_error
+    while not _sync_stop.is_set():
+        try:
+            sync_now()
+        except Exception as error:
+            # Erreur inattendue : le journal est conservé, on réessaiera
+            with _state_lock:
+                _last_error = str(error)
+        _sync_wake.wait(SYNC_INTERVAL_SECONDS)
+        _sync_wake.clear()
+
+
+def _init_replica() -> None:
+    global _ready
+    with _connect() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+    with _connect(write=True) as conn:
+        if _get_meta(conn, "replica_id") is None:
+            _set_meta(conn, "replica_id", uuid.uuid4())
+        _ready = _get_meta(conn, "products_as_of") is not None
+
+
+def start_local_replica() -> None:
+    """Ouvre la réplique et démarre (une seule fois par processus) le thread de synchronisation.
+
+    Au tout premier lancement, la copie initiale est faite avant de rendre
+    la main : elle exige que la base centrale soit joignable.
+    """
+    global _sync_thread
+    with _state_lock:
+        if _sync_thread is not None and _sync_thread.is_alive():
+            return
+    _init_replica()
+    if not _ready and not sync_now():
+        raise RuntimeError(f"Copie initiale de la réplique locale impossible : {_last_error}")
+
+    with _state_lock:
+        _sync_stop.clear()
+        _sync_thread = threading.Thread(target=_sync_loop, name="local-replica-sync", daemon=True)
+        _sync_thread.start()
+    # Les modifications des autres postes déclenchent une synchronisation immédiate
+    db.on_remote_change(_sync_wake.set)
+
+
+def stop_local_replica() -> None:
+    """Arrête le thread de synchronisation (le journal non rejoué est conservé)."""
+    _sync_stop.set()
+    _sync_wake.set()
+    if _sync_thread is not None:
+        _sync_thread.join(timeout=30)
+
+
+def is_ready() -> bool:
+    """Vrai si la réplique contient une copie complète et peut servir les lectures."""
+    return _ready
+
+
+def is_online() -> bool:
+    """Vrai si la dernière synchronisation a joint la base centrale.
+
+    Ne contacte pas la base : les pages s'en servent pour masquer les
+    lectures réservées à la base centrale sans attendre DB_CONNECT_TIMEOUT.
+    """
+    with _state_lock:
+        return _online is True
+
+
+def get_sync_status() -> Dict[str, Any]:
+    """État de la synchronisation pour l'affichage (en ligne, opérations en attente, conflits)."""
+    with _connect() as conn:
+        pending = conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+        conflicts = conn.execute("SELECT COUNT(*) FROM sync_conflicts WHERE acknowledged = 0").fetchone()[0]
+    with _state_lock:
+        return {
+            "ready": _ready,
+            "online": _online,
+            "pending": int(pending),
+            "conflicts": int(conflicts),
+            "last_sync": _last_sync,
+            "last_error": _last_error,
+        }
+
+
+def get_sync_conflicts(include_acknowledged: bool = False, limit: int = 50) -> List[Dict[str, Any]]:
+    """Conflits de synchronisation, du plus récent au plus ancien."""
+    where = "" if include_acknowledged else " WHERE acknowledged = 0"
+    with _connect() as conn:
+        return [dict(row) for row in conn.execute(
+            f"SELECT id, created_at, operation, message FROM sync_conflicts{where} ORDER BY id DESC LIMIT ?",
+            (limit,),
+        )]
+
+
+def acknowledge_conflicts() -> None:
+    """Marque tous les conflits comme vus."""
+    with _connect(write=True) as conn:
+        conn.execute("UPDATE sync_conflicts SET acknowledged = 1 WHERE acknowledged = 0")
+
+
+__all__ = [
+    "start_local_replica",
+    "stop_local_replica",
+    "sync_now",
+    "is_ready",
+    "is_online",
+    "get_sync_status",
+    "get_sync_conflicts",
+    "acknowledge_conflicts",
+]
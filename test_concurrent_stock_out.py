@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Sorties de stock concurrentes sur un même lot (nécessite DATABASE_URL).
+
+Une première vente garde sa transaction ouverte pendant qu'une seconde
+attend le verrou sur la ligne : une fois la première validée, la seconde
+doit réussir tant que le stock restant suffit, y compris quand elle épuise
+le lot.
+"""
+
+import os
+import sys
+import threading
+import time
+from datetime import date, timedelta
+
+# Add current directory to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import db  # noqa: E402
+
+EXPIRY = (date.today() + timedelta(days=400)).isoformat()
+
+
+def _new_lot(name: str, quantity: int) -> int:
+    for product in db.get_products(name):
+        db.delete_product(product["id"])
+    return db.add_product(name, quantity, EXPIRY)
+
+
+def _run_concurrently(first, second):
+    """Lance ``first`` dans une transaction gardée ouverte, puis ``second`` en parallèle."""
+    holding = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def hold_first():
+        try:
+            with db.get_connection() as conn:
+                first(conn)
+                holding.set()
+                release.wait(10)
+        except Exception as e:
+            errors.append(e)
+            holding.set()
+
+    def run_second():
+        try:
+            second()
+        except Exception as e:
+            errors.append(e)
+
+    t1 = threading.Thread(target=hold_first)
+    t1.start()
+    holding.wait(10)
+    t2 = threading.Thread(target=run_second)
+    t2.start()
+    time.sleep(0.5)  # la seconde vente attend le verrou de la première
+    release.set()
+    t1.join(10)
+    t2.join(10)
+    return errors
+
+
+def test_concurrent_remove_stock():
+    """Deux ventes de 5 sur un lot de 10 : les deux passent et le lot est supprimé."""
+    pid = _new_lot("Test concurrence lot", 10)
+    errors = _run_concurrently(
+        lambda conn: db._remove_stock(conn, [(pid, 5, "poste 1")]),
+        lambda: db.remove_stock(pid, 5, "poste 2"),
+    )
+    assert not errors, errors
+    assert db.get_product_by_id(pid) is None
+
+
+def test_concurrent_basket():
+    """Deux paniers qui épuisent ensemble les mêmes lots."""
+    pid_a = _new_lot("Test concurrence panier A", 4)
+    pid_b = _new_lot("Test concurrence panier B", 6)
+    errors = _run_concurrently(
+        lambda conn: db._remove_stock_many(conn, [(pid_a, 2, ""), (pid_b, 3, "")]),
+        lambda: db.remove_stock_many([(pid_a, 2, ""), (pid_b, 3, "")]),
+    )
+    assert not errors, errors
+    assert db.get_product_by_id(pid_a) is None
+    assert db.get_product_by_id(pid_b) is None
+
+
+def test_concurrent_oversell_rejected():
+    """La seconde vente ne peut pas dépasser le stock laissé par la première."""
+    pid = _new_lot("Test concurrence survente", 10)
+    errors = _run_concurrently(
+        lambda conn: db._remove_stock(conn, [(pid, 6, "")]),
+        lambda: db.remove_stock(pid, 6),
+    )
+    assert len(errors) == 1 and isinstance(errors[0], db.InsufficientStockError), errors
+    assert db.get_product_by_id(pid)["quantity"] == 4
+    db.delete_product(pid)
+
+
+if __name__ == "__main__":
+    db.init_db()
+    failed = 0
+    for test in (test_concurrent_remove_stock, test_concurrent_basket, test_concurrent_oversell_rejected):
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {test.__name__}: {e}")
+    sys.exit(1 if failed else 0)